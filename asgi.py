@@ -0,0 +1,395 @@
+"""ASGI entry point of the watchlist, e.g. ``uvicorn asgi:application``.
+
+The index page, the edit page and the read-only JSON API are answered by
+coroutines that query the database through SQLAlchemy's asyncio extension
+(aiosqlite for SQLite files), so a request waiting on the database does not
+hold a thread. The blocking parts around them (loading and saving the
+session, template rendering, compression) run on the loop's thread pool.
+Every other request runs the normal WSGI app on a thread pool.
+"""
+import asyncio
+import contextvars
+import functools
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request, session, current_app, render_template, abort, jsonify
+from flask import Response, make_response
+from flask_login import current_user
+from flask_login.utils import decode_cookie
+from sqlalchemy import select, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException
+
+from app import app, Movie, User, owner_cache, page_cache, count_cache
+from app import watchlist_version, cached_user, cache_user
+from app import apply_sqlite_pragmas, engine_options, keyset_select, keyset_page, movie_page_args
+from app import index_validators, index_page_key, render_index, is_anonymous_request, is_not_modified
+from app import conditional_response, api_validators, movies_payload, reads_pinned_to_writer
+
+#同步驱动对应的异步驱动
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg', 'mysql': 'aiomysql'}
+
+
+def async_database_uri(config, writer=False):
+    """URI of the database the async views read, or ``None`` if they can't have one.
+
+    ``WATCHLIST_ASYNC_DATABASE_URI`` wins; otherwise the read (or main)
+    database URI is switched to the matching async driver. In-memory
+    SQLite can't be shared with a second engine, so it gets none. With
+    ``writer`` it is always the main database.
+    """
+    if config['WATCHLIST_ASYNC_DATABASE_URI'] and not writer:
+        return config['WATCHLIST_ASYNC_DATABASE_URI']
+    if writer:
+        url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    else:
+        url = make_url(config['WATCHLIST_READ_DATABASE_URI'] or config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS or (backend == 'sqlite' and url.database in (None, '', ':memory:')):
+        return None
+    return url.set(drivername='%s+%s' % (backend, ASYNC_DRIVERS[backend]))
+
+
+def create_async_reader(config, writer=False):
+    """Async engine for the async views; its SQLite connections are read-only like the reader's.
+
+    With ``writer`` the engine reads the main database, for sessions that
+    just wrote while a replica is configured (see ``RoutingSession``).
+    """
+    uri = async_database_uri(config, writer)
+    if uri is None:
+        return None
+    options = engine_options(dict(config, SQLALCHEMY_DATABASE_URI=uri))
+    #同步的 TimedQueuePool 不能给异步引擎用
+    options['poolclass'] = AsyncAdaptedQueuePool
+    engine = create_async_engine(uri, **options)
+    if engine.dialect.name == 'sqlite':
+        apply_sqlite_pragmas(engine.sync_engine, dict(config['WATCHLIST_SQLITE_PRAGMAS'], query_only='ON'))
+    return engine
+
+
+def build_environ(scope):
+    """WSGI environ for an ASGI HTTP ``scope``; ``wsgi.input`` starts out empty."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            #HTTP/2 会把 Cookie 拆成多个头
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run the blocking ``func`` on the loop's thread pool, inside the current Flask contexts."""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+def while_handling(func, e):
+    #Flask 的异常处理函数要在 except 块里调用, 换了线程以后重新抛一次
+    try:
+        raise e
+    except Exception:
+        return func(e)
+
+
+def open_session(app, request):
+    #和 RequestContext.push() 里的一样, 但可以放到线程池里做
+    session = app.session_interface.open_session(app, request)
+    return app.session_interface.make_null_session(app) if session is None else session
+
+
+async def send_start(send, status, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+
+
+async def prime_user(db):
+    """Put the logged-in user in user_cache so Flask-Login's load_user() never queries."""
+    user_id = session.get('_user_id')
+    if user_id is None:
+        cookie = request.cookies.get(current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+        user_id = None if cookie is None else decode_cookie(cookie)
+    if user_id is None:
+        return
+    version = await run_sync(watchlist_version.get)
+    if cached_user(int(user_id), version) is not None:
+        return
+    user = await db.get(User, int(user_id))
+    if user is not None:
+        cache_user(version, user)
+
+
+async def prime_owner(db):
+    """Load the owner for the templates' context processor if owner_cache is cold."""
+    version = await run_sync(watchlist_version.get)
+    if owner_cache.loaded(version):
+        return
+    user = (await db.scalars(select(User).limit(1))).first()
+    owner_cache.store(version, user)
+
+
+async def fetch_movie_page(db):
+    args = movie_page_args()
+    items = (await db.scalars(keyset_select(select(Movie), **args))).all()
+    return keyset_page(items, args['columns'], args['after'], args['before'], args['per_page'])
+
+
+async def index(db):
+    version, etag, last_modified = await run_sync(index_validators)
+    if '_flashes' not in session and is_not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        anonymous = is_anonymous_request()
+        key = (version,) + index_page_key()
+        body = page_cache.get(key) if anonymous else None
+        if body is None:
+            page = await fetch_movie_page(db)
+            total = count_cache.get(version)
+            if total is None:
+                total = await db.scalar(select(func.count(Movie.id)))
+                count_cache.set(version, total)
+            await prime_owner(db)
+            body = await run_sync(render_index, page, total)
+            if anonymous:
+                page_cache.set(key, body)
+        response = make_response(body)
+    return conditional_response(response, etag, last_modified, vary_cookie=True)
+
+
+async def edit(db, movie_id):
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    movie = await db.get(Movie, movie_id)
+    if movie is None:
+        abort(404)
+    await prime_owner(db)
+    return await run_sync(render_template, 'edit.html', movie=movie)
+
+
+async def api_movies(db):
+    async def payload():
+        return movies_payload(await fetch_movie_page(db))
+    return await api_response(payload)
+
+
+async def api_movie(db, movie_id):
+    async def payload():
+        movie = await db.get(Movie, movie_id)
+        if movie is None:
+            abort(404)
+        return movie.to_dict()
+    return await api_response(payload)
+
+
+async def api_response(payload):
+    etag, last_modified = await run_sync(api_validators)
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        response = jsonify(await payload())
+    return conditional_response(response, etag, last_modified)
+
+
+#按 endpoint 名字换成异步版本的视图, 只用于 GET 和 HEAD
+ASYNC_VIEWS = {
+    'index': index,
+    'edit': edit,
+    'api_movies': api_movies,
+    'api_movie': api_movie,
+}
+
+
+class WatchlistASGI:
+    """ASGI application for a watchlist Flask ``app``.
+
+    GET and HEAD requests for an endpoint in ``ASYNC_VIEWS`` run as
+    coroutines inside a normal Flask request context, so sessions, login,
+    error handlers and templates behave as under WSGI. The rest go to the
+    WSGI app on a pool of ``WATCHLIST_ASGI_THREADS`` threads, with streamed
+    bodies passed on chunk by chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.engine = create_async_reader(app.config)
+        self.sessions = None if self.engine is None else async_sessionmaker(self.engine, expire_on_commit=False)
+        #有从库时, 刚写过数据的会话改读主库
+        self.writer_engine = None
+        if self.engine is not None and app.config['WATCHLIST_READ_DATABASE_URI']:
+            self.writer_engine = create_async_reader(app.config, writer=True)
+        self.writer_sessions = (None if self.writer_engine is None
+                                else async_sessionmaker(self.writer_engine, expire_on_commit=False))
+        self.executor = ThreadPoolExecutor(app.config['WATCHLIST_ASGI_THREADS'],
+                                           thread_name_prefix='watchlist-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %r' % scope['type'])
+
+        environ = build_environ(scope)
+        view = self.async_view(environ)
+        if view is None:
+            await self.run_wsgi(environ, receive, send)
+        else:
+            await self.run_async(environ, view, send)
+
+    def async_view(self, environ):
+        if self.sessions is None or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return ASYNC_VIEWS.get(endpoint)
+
+    async def run_async(self, environ, view, send):
+        #和 Flask.wsgi_app() / full_dispatch_request() 的流程一致, 只是视图换成协程;
+        #服务器端会话的读写 (SQLite / Redis)、模板渲染和压缩都会阻塞, 放到线程池里
+        app = self.app
+        compressor = app.extensions.get('watchlist_gzip')
+        if compressor is not None:
+            compressor.prepare(environ)
+        ctx = app.request_context(environ)
+        ctx.session = await run_sync(open_session, app, ctx.request)
+        ctx.push()
+        try:
+            try:
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        sessions = self.sessions
+                        if self.writer_sessions is not None and reads_pinned_to_writer():
+                            sessions = self.writer_sessions
+                        async with sessions() as db:
+                            await prime_user(db)
+                            rv = await view(db, **request.view_args)
+                except Exception as e:
+                    rv = await run_sync(while_handling, app.handle_user_exception, e)
+                response = await run_sync(app.finalize_request, rv)
+            except Exception as e:
+                response = await run_sync(while_handling, app.handle_exception, e)
+            status, headers, body = await run_sync(self.encode, environ, response)
+        finally:
+            ctx.pop()
+        await send_start(send, status, headers)
+        await send({'type': 'http.response.body', 'body': body})
+
+    def encode(self, environ, response):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        compressor = self.app.extensions.get('watchlist_gzip')
+        if compressor is not None:
+            status, headers, app_iter = compressor.encode(environ, status, headers, app_iter)
+        return status, headers, b''.join(app_iter)
+
+    async def run_wsgi(self, environ, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body = b''.join(body)
+        #分块上传的请求没有 Content-Length, WSGI 这边需要它才会读 body
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=8)
+        abandoned = threading.Event()
+        started = []
+
+        def put(item):
+            if not abandoned.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return put
+
+        def run():
+            try:
+                app_iter = self.app(environ, start_response)
+                try:
+                    for chunk in app_iter:
+                        if abandoned.is_set():
+                            break
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(app_iter, 'close'):
+                        app_iter.close()
+            finally:
+                put(None)
+
+        future = loop.run_in_executor(self.executor, run)
+        try:
+            chunk = await queue.get()
+            if chunk is None:
+                await future
+            await send_start(send, *started)
+            while chunk is not None:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await queue.get()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            #客户端断开时让工作线程尽快结束, 不再等着往队列里放数据
+            abandoned.set()
+            while not queue.empty():
+                queue.get_nowait()
+        await future
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def aclose(self):
+        for engine in (self.engine, self.writer_engine):
+            if engine is not None:
+                await engine.dispose()
+        self.executor.shutdown(wait=False)
+
+
+application = WatchlistASGI(app)
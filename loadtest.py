@@ -0,0 +1,300 @@
+"""Load generator for the watchlist, e.g. ``python loadtest.py --concurrency 8 --duration 30``.
+
+Starts the app on a scratch database in its own process (``flask run`` by
+default, or any ``--server-command``), seeds it, then drives it from
+``--concurrency`` client threads for ``--duration`` seconds. Every request is
+an anonymous read, a logged-in read, a write or (only when given a weight) a
+login, picked by the weights in ``--mix``. Throughput and p50/p95/p99 latency
+per route are reported as JSON.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+USERNAME = PASSWORD = 'loadtest'
+DEFAULT_SERVER_COMMAND = ('{python} -m flask --app app run --port {port} '
+                          '--with-threads --no-reload --no-debugger')
+
+
+class Client:
+    """One keep-alive connection to the server; records every request it makes."""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.records = []
+
+    def request(self, route, method, path, form=None, cookie=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if cookie is not None:
+            headers['Cookie'] = cookie
+        started = time.perf_counter()
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            #连接出错就重新连, 这次请求记为失败
+            self.conn.close()
+            response = None
+        self.records.append((route, time.perf_counter() - started, None if response is None else response.status))
+        return response
+
+
+class Target:
+    """What the scenarios know about the seeded server."""
+
+    def __init__(self, port, movies, deletable, cookie):
+        self.port = port
+        self.movies = movies
+        self.cookie = cookie
+        self._deletable = list(deletable)
+        self._lock = threading.Lock()
+
+    def take_deletable(self):
+        with self._lock:
+            return self._deletable.pop() if self._deletable else None
+
+
+def anonymous_read(client, target, rng):
+    path = rng.choice(['/', '/?sort=title', '/api/movies', '/api/movies?sort=-year'])
+    client.request('GET ' + path.split('?')[0], 'GET', path)
+
+
+def logged_in_read(client, target, rng):
+    if rng.random() < 0.5:
+        client.request('GET /', 'GET', '/', cookie=target.cookie)
+    else:
+        movie_id = rng.randint(1, target.movies)
+        client.request('GET /movie/edit/<id>', 'GET', '/movie/edit/%d' % movie_id, cookie=target.cookie)
+
+
+def write(client, target, rng):
+    kind = rng.choice(['create', 'update', 'delete'])
+    movie_id = target.take_deletable() if kind == 'delete' else None
+    if movie_id is not None:
+        client.request('POST /movie/delete/<id>', 'POST', '/movie/delete/%d' % movie_id, cookie=target.cookie)
+    elif kind == 'update':
+        movie_id = rng.randint(1, target.movies)
+        form = dict(title='Edited %d' % movie_id, year='2024')
+        client.request('POST /movie/edit/<id>', 'POST', '/movie/edit/%d' % movie_id, form, target.cookie)
+    else:
+        form = dict(title='Load test %d' % rng.randint(1, 10 ** 6), year='2024')
+        client.request('POST /', 'POST', '/', form, target.cookie)
+
+
+def login(client, target, rng):
+    #每次都要算一遍密码散列, 默认的 --mix 里没有, 需要时单独加上
+    client.request('POST /login', 'POST', '/login', dict(username=USERNAME, password=PASSWORD))
+
+
+SCENARIOS = {
+    'anonymous': anonymous_read,
+    'logged_in': logged_in_read,
+    'write': write,
+    'login': login,
+}
+
+
+def parse_mix(text):
+    """``anonymous=70,logged_in=20,write=10`` -> ``{'anonymous': 70.0, ...}``."""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError('unknown scenario %r, expected one of %s' % (name, ', '.join(SCENARIOS)))
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad weight for %r' % name)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('the mix needs a positive weight')
+    return mix
+
+
+def percentile(values, q):
+    """Nearest-rank percentile ``q`` of the sorted list ``values``."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(q / 100.0 * len(values)) - 1)]
+
+
+def summarize(records, elapsed):
+    """Turn ``(route, seconds, status)`` records into the JSON report."""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    for route, latency, status in records:
+        latencies[route].append(latency)
+        if status is None or status >= 400:
+            errors[route] += 1
+
+    def ms(seconds):
+        return round(seconds * 1000, 2)
+
+    routes = {}
+    for route, values in sorted(latencies.items()):
+        values.sort()
+        routes[route] = dict(
+            requests=len(values),
+            errors=errors[route],
+            throughput=round(len(values) / elapsed, 2),
+            p50=ms(percentile(values, 50)),
+            p95=ms(percentile(values, 95)),
+            p99=ms(percentile(values, 99)),
+            max=ms(values[-1]),
+        )
+    return dict(
+        duration=round(elapsed, 3),
+        requests=len(records),
+        errors=sum(errors.values()),
+        throughput=round(len(records) / elapsed, 2),
+        routes=routes,
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def flask_command(env, *args):
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app'] + list(args),
+                   cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def seed(env, workdir, movies, deletable):
+    """Create the scratch database: ``movies + deletable`` rows and the login user."""
+    path = os.path.join(workdir, 'movies.csv')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('title,year\n')
+        for i in range(movies + deletable):
+            f.write('Movie %d,%d\n' % (i, 1950 + i % 70))
+    flask_command(env, 'initdb')
+    flask_command(env, 'import', path)
+    flask_command(env, 'admin', '--username', USERNAME, '--password', PASSWORD)
+
+
+def wait_for_server(port, server, log, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            with open(log, encoding='utf-8', errors='replace') as f:
+                raise SystemExit('Server exited with %s:\n%s' % (server.returncode, f.read()))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit('Server did not start listening on port %d' % port)
+
+
+def session_cookie(response):
+    cookie = response.getheader('Set-Cookie')
+    return None if cookie is None else cookie.split(';', 1)[0]
+
+
+def log_in(port):
+    """Log in once and return a session cookie with no flashed messages left in it."""
+    client = Client(port)
+    response = client.request('POST /login', 'POST', '/login', dict(username=USERNAME, password=PASSWORD))
+    cookie = session_cookie(response)
+    if response.status != 302 or cookie is None:
+        raise SystemExit('Login failed with status %s' % response.status)
+    #取一次首页把 "Login success." 消费掉, 之后的请求都带着干净的会话
+    cookie = session_cookie(client.request('GET /', 'GET', '/', cookie=cookie)) or cookie
+    return cookie
+
+
+def drive(target, concurrency, duration, mix):
+    """Run the clients for ``duration`` seconds; returns ``(records, elapsed seconds)``."""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    clients = [Client(target.port) for _ in range(concurrency)]
+    deadline = time.perf_counter() + duration
+
+    def work(client):
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            SCENARIOS[rng.choices(names, weights)[0]](client, target, rng)
+
+    threads = [threading.Thread(target=work, args=(client,)) for client in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return [record for client in clients for record in client.records], elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', type=int, default=8, help='Client threads (default: 8).')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run (default: 10).')
+    parser.add_argument('--mix', type=parse_mix, default='anonymous=70,logged_in=20,write=10',
+                        help='Scenario weights (default: anonymous=70,logged_in=20,write=10).')
+    parser.add_argument('--movies', type=int, default=500, help='Movies seeded before the run (default: 500).')
+    parser.add_argument('--server-command', default=DEFAULT_SERVER_COMMAND,
+                        help='Command that starts the server; {port} and {python} are filled in.')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='watchlist-loadtest-')
+    #版本号文件默认放在 data.db 旁边, 也就在 workdir 里; 登录限流放宽到压测打不满, 否则 login 场景全是 429
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(workdir, 'data.db'), FLASK_DEBUG='0')
+    env.setdefault('WATCHLIST_LOGIN_IP_LIMIT', '1000000/1')
+    env.setdefault('WATCHLIST_LOGIN_USERNAME_LIMIT', '1000000/1')
+    server = None
+    try:
+        #写请求里的删除要有东西可删, 多备一些只用来删除的条目
+        deletable = args.movies
+        seed(env, workdir, args.movies, deletable)
+        port = free_port()
+        log = os.path.join(workdir, 'server.log')
+        command = shlex.split(args.server_command.format(port=port, python=shlex.quote(sys.executable)))
+        with open(log, 'w') as log_file:
+            server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        wait_for_server(port, server, log)
+
+        deletable_ids = range(args.movies + 1, args.movies + deletable + 1)
+        target = Target(port, args.movies, deletable_ids, log_in(port))
+        records, elapsed = drive(target, args.concurrency, args.duration, args.mix)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = summarize(records, elapsed)
+    report['config'] = dict(concurrency=args.concurrency, duration=args.duration, mix=args.mix,
+                            movies=args.movies, server_command=args.server_command)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,41 @@
+import asyncio
+import gzip
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from datetime import datetime, timezone
+from flask import current_app, g
 from werkzeug import *
 
-from app import app, db, Movie, User, forge, initdb
+from app import db, Movie, User, forge, initdb
+from app import keyset_paginate, SORT_KEYS, owner_cache, user_cache, load_user, cached_user
+from app import create_app, warm_up, migrate, MIGRATIONS, import_movies, export_movies
+from app import page_cache, watchlist_version, fragment_cache, checkpoint, wal_checkpointer, count_cache
+from app import encode_cursor, _fork_engines
+from app import engine_options, pool_stats, TimedQueuePool, password_hasher, PasswordHasher
+from app import index_validators, render_index
+from app import PasswordHasherBusy
+from app import login_throttle, TokenBuckets, create_session_store, ServerSessionInterface
+from app import build_assets
+from sqlalchemy import event
+import loadtest
+
+try:
+    import asgi
+except ImportError: # ASGI 入口需要可选的 aiosqlite
+    asgi = None
+
+# 设置后会对这个服务器数据库 (例如本地的 PostgreSQL) 跑一遍基本的增删改查
+TEST_DATABASE_URL = os.environ.get('WATCHLIST_TEST_DATABASE_URL')
+
+# 冷启动预算: python -X importtime 测得 import app 的累计耗时上限(微秒),
+# 实测约 0.43-0.6 秒, 默认留 1.5 倍左右的余量; 慢机器上用环境变量放宽
+IMPORT_TIME_BUDGET = int(os.environ.get('WATCHLIST_IMPORT_TIME_BUDGET', 750000))
 
 #测试继承unittest.TestCase继承类
 class WatchlistTestCase(unittest.TestCase):
@@ -9,13 +43,16 @@ class WatchlistTestCase(unittest.TestCase):
     # 固件测试 -------------------------------------------
     # setUp 准备好需要准备的内容
     def setUp(self):
-        #更新配置
-        app.config.update(
+        #每个测试用自己的应用和临时数据库, 不碰开发用的 data.db
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app(dict(
             # 测试模式 -> True
             TESTING=True,
-            # 使用SQLite内存型数据库，不干扰开发使用的模拟数据库文件
-            SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'
-        )
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.tmp.name, 'data.db'),
+            WATCHLIST_VERSION_FILE=os.path.join(self.tmp.name, 'data.version'),
+        ))
+        self.context = self.app.app_context()
+        self.context.push()
 
         db.create_all()
 
@@ -26,21 +63,72 @@ class WatchlistTestCase(unittest.TestCase):
         db.session.add_all([user, movie])
         db.session.commit()
 
-        self.client = app.test_client()  # create test client
-        self.runner = app.test_cli_runner()  # create test runner
+        self.client = self.app.test_client()  # create test client
+        self.runner = self.app.test_cli_runner()  # create test runner
     
     # tearDown 打扫
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        db.engine.dispose()
+        if self.app.extensions['watchlist_reader'] is not None:
+            self.app.extensions['watchlist_reader'].dispose()
+        password_hasher.shutdown()
+        self.context.pop()
+        self.tmp.cleanup()
 
     # 测试程序实例是否存在
     def test_app_exist(self):
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
 
     # 测试程序是否处于测试模式
     def test_app_is_testing(self):
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
+
+    # 测试启动时的导入开销
+    def test_import_time(self):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import app'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        )
+        timings = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            timings[name.strip()] = int(cumulative)
+
+        for module in ('turtle', 'tkinter', 'audioop'):
+            self.assertNotIn(module, timings)
+        self.assertLess(timings['app'], IMPORT_TIME_BUDGET)
+
+    # 测试程序工厂和预热
+    def test_create_app_warm_up(self):
+        config = dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+        # 数据库还没建表时预热也不能失败
+        create_app(dict(config, WATCHLIST_WARM_UP=True))
+
+        other = create_app(config)
+        self.assertIsNot(other, self.app)
+        with other.app_context():
+            db.create_all()
+            db.session.add(User(name='Warm', username='warm'))
+            db.session.commit()
+        warm_up(other)
+        self.assertEqual(len(other.jinja_env.cache), len(other.jinja_env.list_templates()))
+
+        with other.app_context():
+            statements = self.capture_queries(lambda: self.assertEqual(owner_cache.get().name, 'Warm'))
+            self.assertEqual(statements, [])
+            self.assertEqual(cached_user(1, watchlist_version.get()).username, 'warm')
+
+        # 预热别的应用不会动到当前应用的缓存, 重复预热也不会多留 fork 钩子
+        self.assertEqual(owner_cache.get().name, 'Test')
+        self.assertEqual(user_cache.get(1), None)
+        engines = len(_fork_engines)
+        warm_up(other)
+        self.assertEqual(len(_fork_engines), engines)
 
     #----------------------------------------------------
 
@@ -59,6 +147,78 @@ class WatchlistTestCase(unittest.TestCase):
     #     self.assertIn('Test Movie Title', data)
     #     self.assertEqual(response.status_code, 200)
 
+    # 辅助方法，记录一段代码执行的 SQL 语句
+    def capture_queries(self, func):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # 只读请求的查询走 reader 连接, 两个都要记录
+        engines = [db.engine]
+        reader = current_app.extensions.get('watchlist_reader')
+        if reader is not None:
+            engines.append(reader)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func()
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    # test owner cache
+    def test_owner_cache(self):
+        self.client.get('/undefine')
+        statements = self.capture_queries(lambda: self.client.get('/undefine'))
+        self.assertEqual(statements, [])
+
+        # 修改名字后缓存失效
+        user = User.query.first()
+        user.name = 'Renamed'
+        db.session.commit()
+        owner_cache.invalidate()
+        watchlist_version.bump()
+        data = self.client.get('/undefine').get_data(as_text=True)
+        self.assertIn('Renamed\'s Watchlist', data)
+
+        # 别的进程改名只会改版本号, 不会调用本进程的 invalidate()
+        user.name = 'Elsewhere'
+        db.session.commit()
+        watchlist_version.bump()
+        # 测试共用外层的应用上下文, g 里记下的快照要手动丢掉
+        g.pop('owner', None)
+        data = self.client.get('/undefine').get_data(as_text=True)
+        self.assertIn('Elsewhere\'s Watchlist', data)
+
+    # test load_user cache
+    def test_user_cache(self):
+        stats = user_cache.stats()
+        user = load_user('1')
+        self.assertEqual(user.username, 'test')
+        self.assertFalse(hasattr(user, 'password_hash'))
+        with self.assertRaises(AttributeError):
+            user.name = 'Changed'
+
+        statements = self.capture_queries(lambda: load_user('1'))
+        self.assertEqual(statements, [])
+        self.assertEqual(user_cache.stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(user_cache.stats()['misses'], stats['misses'] + 1)
+
+        # set_password 之后缓存失效
+        User.query.first().set_password('456')
+        db.session.commit()
+        statements = self.capture_queries(lambda: load_user('1'))
+        self.assertEqual(len(statements), 1)
+        self.assertIsNone(load_user('42'))
+
+        # 别的进程改了用户只会改版本号, 不会调用本进程的 invalidate()
+        db.session.execute(db.update(User).filter_by(id=1).values(name='Elsewhere'))
+        db.session.commit()
+        watchlist_version.bump()
+        self.assertEqual(load_user('1').name, 'Elsewhere')
+
     # 辅助方法，用于登录，follow_redirects=True跟随重定向，返回重定向后的相应
     def login(self):
         self.client.post('/login', data=dict(
@@ -97,6 +257,367 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Item created.', data)
         self.assertIn('Invalid input', data)
 
+        # 创建条目，但年份不是 ASCII 数字
+        response = self.client.post('/', data=dict(
+            title='New Movie',
+            year='²'
+        ), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertNotIn('Item created.', data)
+        self.assertIn('Invalid input', data)
+
+    # test keyset pagination
+    def test_index_pagination(self):
+        db.session.add_all([Movie(title='Movie %02d' % i, year='2000') for i in range(30)])
+        db.session.commit()
+
+        response = self.client.get('/?per_page=10')
+        data = response.get_data(as_text=True)
+        self.assertIn('31 Titles', data)
+        self.assertIn('Test Movie title', data)
+        self.assertIn('Movie 08', data)
+        self.assertNotIn('Movie 09', data)
+        self.assertIn('Next', data)
+        self.assertNotIn('Previous', data)
+
+        page = keyset_paginate(Movie.query, SORT_KEYS['id'], per_page=10)
+        page = keyset_paginate(Movie.query, SORT_KEYS['id'], after=[page.items[-1].id], per_page=10)
+        self.assertEqual(page.items[0].title, 'Movie 09')
+        self.assertTrue(page.has_prev)
+        self.assertTrue(page.has_next)
+
+        response = self.client.get('/?per_page=10&after=' + page.next_cursor)
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 19', data)
+        self.assertNotIn('Movie 18', data)
+        self.assertIn('Previous', data)
+
+        response = self.client.get('/?per_page=10&before=' + page.prev_cursor)
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie title', data)
+        self.assertNotIn('Movie 09', data)
+
+        # 按标题倒序
+        response = self.client.get('/?sort=-title&per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie title', data)
+        self.assertIn('Movie 29', data)
+        self.assertNotIn('Movie 28', data)
+
+        # 非法 cursor / 排序键
+        self.assertEqual(self.client.get('/?after=broken').status_code, 400)
+        self.assertEqual(self.client.get('/?sort=password').status_code, 400)
+        for values in ([{'a': 1}], [True], ['1'], [1, 1]):
+            self.assertEqual(self.client.get('/api/movies?after=' + encode_cursor(values)).status_code, 400)
+        self.assertEqual(self.client.get('/api/movies?sort=title&after=' + encode_cursor(['M', 3])).status_code, 200)
+
+        # 总数按列表版本缓存, 每次渲染不再 count
+        self.login()
+        self.client.get('/')
+        statements = self.capture_queries(lambda: self.client.get('/?per_page=5'))
+        self.assertFalse([s for s in statements if 'count(' in s.lower()])
+
+    # test full-text search
+    def test_search(self):
+        self.login()
+        db.session.add_all([
+            Movie(title='My Neighbor Totoro', year=1988),
+            Movie(title='Totoro Returns', year=2030),
+            Movie(title='Leon', year=1994),
+        ])
+        db.session.commit()
+
+        data = self.client.get('/search?q=toto').get_data(as_text=True)
+        self.assertIn('2 Results', data)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertNotIn('Leon', data)
+
+        # 前缀匹配, 多个词都要命中
+        data = self.client.get('/search?q=neigh+TOT').get_data(as_text=True)
+        self.assertIn('1 Results', data)
+
+        data = self.client.get('/search?q=toto&per_page=1').get_data(as_text=True)
+        self.assertIn('Next', data)
+        data = self.client.get('/search?q=toto&per_page=1&page=2').get_data(as_text=True)
+        self.assertIn('Previous', data)
+        self.assertNotIn('Next', data)
+
+        # 编辑和删除之后索引同步
+        movie = Movie.query.filter_by(title='Leon').first()
+        self.client.post('/movie/edit/%d' % movie.id, data=dict(title='The Professional', year='1994'))
+        data = self.client.get('/search?q=profess').get_data(as_text=True)
+        self.assertIn('The Professional', data)
+        self.client.post('/movie/delete/%d' % movie.id)
+        data = self.client.get('/search?q=profess').get_data(as_text=True)
+        self.assertIn('0 Results', data)
+
+        data = self.client.get('/search?q="').get_data(as_text=True)
+        self.assertIn('0 Results', data)
+
+    # test conditional GET
+    def test_index_etag(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertEqual(response.status_code, 200)
+
+        statements = []
+        def conditional_get():
+            statements.append(self.client.get('/', headers={'If-None-Match': etag}))
+        self.assertEqual(self.capture_queries(conditional_get), [])
+        response = statements[0]
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.client.get('/', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # 修改之后 ETag 改变
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2023'))
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Item created.', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    # test 版本号文件默认放在数据库旁边, 写不了时退回进程内
+    def test_version_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmp, 'data.db')))
+            self.assertEqual(other.config['WATCHLIST_VERSION_FILE'], os.path.join(tmp, 'data.version'))
+            self.assertIsNone(create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'))
+                              .config['WATCHLIST_VERSION_FILE'])
+
+            path = os.path.join(tmp, 'missing', 'data.version')
+            other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                                    WATCHLIST_VERSION_FILE=path))
+            with other.app_context():
+                with self.assertLogs('app', 'WARNING'):
+                    version = watchlist_version.get()
+                self.assertGreater(watchlist_version.bump(), version)
+                self.assertGreater(watchlist_version.get(), version)
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    # test 一个请求只读一次版本号, 别的 worker 中途改了列表也不会把数据缓存到别的版本号下
+    def test_version_once_per_request(self):
+        path = self.app.config['WATCHLIST_VERSION_FILE']
+        with self.app.test_request_context('/'):
+            g.pop('watchlist_version', None)
+            version, _, _ = index_validators()
+            # 另一个 worker 加了一部电影, 改了版本号文件
+            db.session.add(Movie(title='Other Worker', year=2023))
+            db.session.commit()
+            with open(path, 'w') as f:
+                f.write(str(version + 10))
+            html = render_index()
+            self.assertIn('Other Worker', html)
+            self.assertEqual(count_cache.get(version), 2)
+            self.assertIsNone(count_cache.get(version + 10))
+            keys = [key for key, _ in fragment_cache._data.items()]
+            self.assertTrue(keys)
+            self.assertTrue(all(key[1] == version for key in keys))
+        g.pop('watchlist_version', None)
+        self.assertEqual(watchlist_version.get(), version + 10)
+
+    # test 版本号存在服务器数据库里 (这里用两个连同一个 SQLite 文件的应用模拟两台主机)
+    def test_version_in_database(self):
+        self.assertFalse(self.app.extensions['watchlist_version'].in_database)
+        with tempfile.TemporaryDirectory() as tmp:
+            config = dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmp, 'data.db'),
+                          WATCHLIST_VERSION_STORE='database')
+            first, second = create_app(config), create_app(config)
+            with first.app_context():
+                db.create_all()
+                version = watchlist_version.get()
+            with second.app_context():
+                self.assertEqual(watchlist_version.get(), version)
+
+            # 改动和版本号在同一个事务里提交
+            with first.app_context():
+                db.session.add(Movie(title='Shared', year=2023))
+                watchlist_version.commit(db.session)
+                self.assertGreater(watchlist_version.get(), version)
+                version = watchlist_version.get()
+            with second.app_context():
+                self.assertEqual(watchlist_version.get(), version)
+
+            # 回滚时版本号也不变
+            with first.app_context():
+                db.session.add(Movie(title='Rolled back', year=2023))
+                watchlist_version.bump(db.session)
+                db.session.rollback()
+            with second.app_context():
+                self.assertEqual(watchlist_version.get(), version)
+                db.session.remove()
+                db.engine.dispose()
+            with first.app_context():
+                db.session.remove()
+                db.engine.dispose()
+
+    # test 从库落后时: 刚写过的用户读主库, 其他人的缓存和从库的版本号一致
+    def test_read_replica_lag(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            main, replica = os.path.join(tmp, 'data.db'), os.path.join(tmp, 'replica.db')
+            other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + main,
+                                    WATCHLIST_READ_DATABASE_URI='sqlite:///' + replica,
+                                    WATCHLIST_VERSION_STORE='database', WATCHLIST_PASSWORD_WORKERS=0))
+            with other.app_context():
+                db.create_all()
+                user = User(name='Replica', username='replica')
+                user.set_password('123')
+                db.session.add(user)
+                watchlist_version.commit(db.session)
+                # 从库是主库此刻的快照, 之后不再同步
+                with sqlite3.connect(main) as source, sqlite3.connect(replica) as target:
+                    source.backup(target)
+
+            anonymous, client = other.test_client(), other.test_client()
+            etag = anonymous.get('/').headers['ETag']
+            client.post('/login', data=dict(username='replica', password='123'))
+            data = client.post('/', data=dict(title='Lagging', year='2023'), follow_redirects=True).get_data(as_text=True)
+            self.assertIn('Item created.', data)
+            self.assertIn('Lagging', data)
+
+            # 没写过的访客读从库, 页面和 ETag 都还是从库上的版本
+            response = anonymous.get('/')
+            self.assertNotIn('Lagging', response.get_data(as_text=True))
+            self.assertEqual(response.headers['ETag'], etag)
+
+            # 过了时限以后也回到从库
+            with client.session_transaction() as sess:
+                sess['_read_writer_until'] = 0
+            self.assertNotIn('Lagging', client.get('/').get_data(as_text=True))
+            with client.session_transaction() as sess:
+                self.assertNotIn('_read_writer_until', sess)
+
+            with other.app_context():
+                db.session.remove()
+                db.engine.dispose()
+                other.extensions['watchlist_reader'].dispose()
+
+    # test anonymous page cache
+    def test_page_cache(self):
+        first = self.client.get('/').get_data(as_text=True)
+        stats = page_cache.stats()
+        responses = []
+        statements = self.capture_queries(lambda: responses.append(self.client.get('/')))
+        self.assertEqual(statements, [])
+        self.assertEqual(responses[0].get_data(as_text=True), first)
+        self.assertEqual(page_cache.stats()['hits'], stats['hits'] + 1)
+
+        # 无关的查询参数不会生成新的缓存条目
+        size = page_cache.stats()['size']
+        statements = self.capture_queries(lambda: responses.append(self.client.get('/?utm_source=x&_=1')))
+        self.assertEqual(statements, [])
+        self.assertEqual(page_cache.stats()['size'], size)
+
+        self.client.get('/undefine')
+        statements = self.capture_queries(lambda: responses.append(self.client.get('/undefine')))
+        self.assertEqual(statements, [])
+        self.assertEqual(responses[-1].status_code, 404)
+
+        # 版本号变化后重新渲染
+        Movie.query.first().title = 'Changed Title'
+        db.session.commit()
+        watchlist_version.bump()
+        self.assertIn('Changed Title', self.client.get('/').get_data(as_text=True))
+
+        # 登录用户不走缓存
+        self.login()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Logout', data)
+        self.assertIn('Changed Title', data)
+
+    # test template fragment cache
+    def test_fragment_cache(self):
+        self.login()
+        self.client.get('/')
+        stats = fragment_cache.stats()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertEqual(fragment_cache.stats()['hits'], stats['hits'] + 2)
+        self.assertIn('Test Movie title', data)
+        self.assertIn('Logout', data)
+
+        # 闪现消息照常显示, 列表改变后片段重新渲染
+        data = self.client.post('/', data=dict(title='Fragment Movie', year='2023'),
+                                follow_redirects=True).get_data(as_text=True)
+        self.assertIn('Item created.', data)
+        self.assertIn('Fragment Movie', data)
+
+    # test JSON API
+    def test_api_movies(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i) for i in range(4)])
+        db.session.commit()
+
+        response = self.client.get('/api/movies?per_page=2')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual([m['title'] for m in data['movies']], ['Test Movie title', 'Movie 0'])
+        self.assertIsNone(data['prev'])
+
+        data = self.client.get('/api/movies?per_page=2&after=' + data['next']).get_json()
+        self.assertEqual([m['title'] for m in data['movies']], ['Movie 1', 'Movie 2'])
+        self.assertIsNotNone(data['prev'])
+
+        data = self.client.get('/api/movies?sort=-year&per_page=1').get_json()
+        self.assertEqual(data['movies'][0]['year'], 2023)
+
+        response = self.client.get('/api/movies/2')
+        self.assertEqual(response.get_json()['title'], 'Movie 0')
+        statements = self.capture_queries(lambda: self.assertEqual(
+            self.client.get('/api/movies/2', headers={'If-None-Match': response.headers['ETag']}).status_code, 304))
+        self.assertEqual(statements, [])
+
+        response = self.client.get('/api/movies/42')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error'], 'Not found.')
+        self.assertEqual(self.client.get('/api/movies?after=broken').status_code, 400)
+
+    # test batch mutations
+    def test_api_batch(self):
+        operations = [
+            dict(op='create', title='Batch One', year=2001),
+            dict(op='create', title='Batch Two', year='2002'),
+            dict(op='update', id=1, title='Batch Edited', year='1999'),
+        ]
+        response = self.client.post('/api/movies/batch', json=operations)
+        self.assertEqual(response.status_code, 401)
+
+        self.login()
+        response = self.client.post('/api/movies/batch', json=operations)
+        data = response.get_json()
+        self.assertTrue(data['applied'])
+        self.assertEqual([r['id'] for r in data['results']], [2, 3, 1])
+        self.assertEqual(db.session.get(Movie, 1).title, 'Batch Edited')
+        self.assertEqual(Movie.query.count(), 3)
+
+        # 任意一个操作不合法时全部不生效
+        response = self.client.post('/api/movies/batch', json=[
+            dict(op='delete', id=2),
+            dict(op='update', id=3, title='Batch Two', year='99'),
+            dict(op='delete', id=42),
+            dict(op='rename'),
+        ])
+        self.assertEqual(response.status_code, 400)
+        data = response.get_json()
+        self.assertFalse(data['applied'])
+        self.assertEqual([r['ok'] for r in data['results']], [True, False, False, False])
+        self.assertEqual(data['results'][2]['error'], 'Not found.')
+        self.assertEqual(Movie.query.count(), 3)
+
+        response = self.client.post('/api/movies/batch', json=[dict(op='delete', id=2)])
+        self.assertTrue(response.get_json()['applied'])
+        self.assertEqual(Movie.query.count(), 2)
+        self.assertEqual(self.client.post('/api/movies/batch', json={'op': 'create'}).status_code, 400)
+
+        # true 不能当成 id 1, year 也一样
+        response = self.client.post('/api/movies/batch', json=[dict(op='delete', id=True)])
+        self.assertEqual(response.get_json()['results'][0]['error'], 'Not found.')
+        response = self.client.post('/api/movies/batch', json=[dict(op='create', title='Bool', year=True)])
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNotNone(db.session.get(Movie, 1))
+
     # test update
     def test_update_item(self):
         self.login()
@@ -204,6 +725,207 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid input.', data)
 
+    # test 密码散列在进程池里算, 登录时换成新的散列方法
+    def test_password_hasher(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1)
+        try:
+            pwhash = hasher.hash('secret')
+            self.assertTrue(pwhash.startswith('pbkdf2:sha256:1000$'))
+            self.assertTrue(hasher.verify(pwhash, 'secret'))
+            self.assertFalse(hasher.verify(pwhash, 'wrong'))
+            self.assertFalse(hasher.needs_rehash(pwhash))
+            self.assertTrue(PasswordHasher(workers=0).needs_rehash(pwhash))
+            # 不写强度时按 Werkzeug 的默认迭代次数比较
+            default = PasswordHasher('pbkdf2:sha256', workers=0)
+            self.assertEqual(default.method, 'pbkdf2:sha256:260000')
+            self.assertFalse(default.needs_rehash('pbkdf2:sha256:260000$salt$hash'))
+
+            # 子进程挂掉后报 PasswordHasherBusy, 之后换一个新的进程池
+            with self.assertRaises(PasswordHasherBusy):
+                hasher._run(os._exit, 1)
+            self.assertTrue(hasher.verify(pwhash, 'secret'))
+        finally:
+            hasher.shutdown()
+
+        method = password_hasher.method
+        password_hasher.method = 'pbkdf2:sha256:2000'
+        try:
+            self.login()
+            self.assertTrue(User.query.first().password_hash.startswith('pbkdf2:sha256:2000$'))
+            self.assertTrue(User.query.first().validate_password('123'))
+        finally:
+            password_hasher.method = method
+
+        result = self.runner.invoke(args=['hash-cost', '--target', '20'])
+        self.assertIn('Suggested: pbkdf2:sha256:', result.output)
+        self.assertIn('WATCHLIST_PASSWORD_METHOD', result.output)
+
+        # 进程池来不及回答时返回 503, 不是 500
+        workers, timeout = password_hasher.workers, password_hasher.timeout
+        password_hasher.workers, password_hasher.timeout = 1, 0
+        try:
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 503)
+            self.assertIsNotNone(response.retry_after)
+            self.assertIn('Login is busy', response.get_data(as_text=True))
+        finally:
+            password_hasher.shutdown()
+            password_hasher.workers, password_hasher.timeout = workers, timeout
+
+    # test 登录限流
+    def test_login_throttle(self):
+        limits = login_throttle.limits
+        login_throttle.limits = dict(ip=(4, 60), username=(2, 60))
+        rejected = dict(login_throttle.rejected)
+        try:
+            for _ in range(2):
+                self.client.post('/login', data=dict(username='Test', password='456'))
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Too many login attempts', response.get_data(as_text=True))
+            self.assertGreater(response.retry_after, datetime.now(timezone.utc))
+            self.assertEqual(login_throttle.rejected['username'], rejected['username'] + 1)
+
+            # 换用户名也逃不过 IP 的限制
+            self.assertEqual(self.client.post('/login', data=dict(username='other', password='1')).status_code, 302)
+            self.assertEqual(self.client.post('/login', data=dict(username='third', password='1')).status_code, 429)
+            self.assertEqual(login_throttle.rejected['ip'], rejected['ip'] + 1)
+        finally:
+            login_throttle.limits = limits
+
+        # 用 SQLite 文件时多个实例(进程)共享同一个桶
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'throttle.db')
+            first, second = TokenBuckets(path), TokenBuckets(path)
+            self.assertEqual(first.take('ip:1', 2, 0.01), 0)
+            self.assertEqual(second.take('ip:1', 2, 0.01), 0)
+            self.assertGreater(first.take('ip:1', 2, 0.01), 0)
+
+        # 限额也可以用环境变量设置 (压测脚本用它放宽限流)
+        os.environ['WATCHLIST_LOGIN_USERNAME_LIMIT'] = '100/1'
+        try:
+            other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'))
+        finally:
+            del os.environ['WATCHLIST_LOGIN_USERNAME_LIMIT']
+        self.assertEqual(other.extensions['watchlist_login_throttle'].limits, dict(ip=(20, 60), username=(100, 1)))
+
+    # test 服务器端会话: cookie 里只有 sid, 会话没变时不写存储
+    def test_server_session(self):
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                                WATCHLIST_SESSION_STORE='memory'))
+        with other.app_context():
+            db.create_all()
+            user = User(name='Session', username='session')
+            user.set_password('pw')
+            db.session.add(user)
+            db.session.commit()
+        store = other.session_interface.store
+        client = other.test_client()
+
+        def sid():
+            return next(cookie.value for cookie in client.cookie_jar if cookie.name == 'session')
+
+        client.post('/login', data=dict(username='', password=''))
+        anonymous = sid()
+        self.assertEqual(len(anonymous), 43)
+        client.post('/login', data=dict(username='session', password='pw'))
+        self.assertNotEqual(sid(), anonymous)
+        self.assertIsNone(store.load(anonymous))
+        self.assertIn('Login success.', client.get('/').get_data(as_text=True))
+
+        response = client.get('/')
+        self.assertIn('Logout', response.get_data(as_text=True))
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertIn('Cookie', response.headers['Vary'])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            interface = ServerSessionInterface(create_session_store('sqlite:///' + os.path.join(tmp, 's.db'), 60))
+            data = {'_flashes': [('message', 'Bye. ' * 200)], '_user_id': '1'}
+            interface.store.save('abc', interface.encode(data))
+            encoded = interface.store.load('abc')
+            self.assertLess(len(encoded), 200)
+            self.assertEqual(interface.decode(encoded), data)
+            interface.store.delete('abc')
+            self.assertIsNone(interface.store.load('abc'))
+        self.assertRaises(ValueError, create_session_store, 'file:///tmp/sessions', 60)
+
+    # test 带内容散列的静态文件, 从内存提供并预先压缩
+    def test_static_assets(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = build_assets(self.app.static_folder, tmp)
+            self.assertIn('images/totoro.gif', manifest)
+            self.assertTrue(os.path.exists(os.path.join(tmp, manifest['style.css'] + '.gz')))
+            self.assertFalse(os.path.exists(os.path.join(tmp, manifest['images/avatar.png'] + '.gz')))
+
+            other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                                    WATCHLIST_ASSET_DIR=tmp))
+        with other.app_context():
+            db.create_all()
+            db.session.add(User(name='Assets', username='assets'))
+            db.session.commit()
+        client = other.test_client()
+
+        data = client.get('/').get_data(as_text=True)
+        self.assertIn('/static/%s"' % manifest['style.css'], data)
+        self.assertIn('/static/%s"' % manifest['images/totoro.gif'], data)
+
+        with open(os.path.join(self.app.static_folder, 'style.css'), 'rb') as f:
+            css = f.read()
+        url = '/static/' + manifest['style.css']
+        response = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), css)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        response = client.get(url)
+        self.assertIsNone(response.content_encoding)
+        self.assertEqual(response.get_data(), css)
+        self.assertEqual(client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+        # 没有经过构建的名字照常提供
+        response = client.get('/static/style.css')
+        self.assertEqual(response.get_data(), css)
+        response.close()
+
+        # 重新构建以后, 旧页面引用的上一版文件还能取到
+        with tempfile.TemporaryDirectory() as tmp:
+            build_assets(self.app.static_folder, tmp)
+            with open(os.path.join(tmp, 'style.0123456789ab.css'), 'wb') as f:
+                f.write(b'old')
+            other.extensions['watchlist_assets'].load(tmp)
+            response = client.get('/static/style.0123456789ab.css')
+            self.assertEqual(response.get_data(), b'old')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(client.get('/static/manifest.json').status_code, 404)
+            self.assertEqual(client.get('/static/../../app.0123456789ab.py').status_code, 404)
+
+    # test 模板字节码缓存和预编译
+    def test_compile_templates(self):
+        self.assertIsNone(self.app.jinja_env.bytecode_cache)
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_dir = os.path.join(tmp, 'jinja')
+            config = dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:',
+                          WATCHLIST_TEMPLATE_CACHE_DIR=cache_dir, WATCHLIST_PRODUCTION=True)
+            first = create_app(config)
+            self.assertFalse(first.jinja_env.auto_reload)
+            # 创建应用时不建目录, 由 compile-templates 建
+            self.assertFalse(os.path.exists(cache_dir))
+            count = len(first.jinja_env.list_templates())
+            # 外层已经有应用上下文, 命令只会用当前的那个
+            with first.app_context():
+                result = first.test_cli_runner().invoke(args=['compile-templates'])
+                self.assertIn('Compiled %d templates (0 already up to date)' % count, result.output)
+                self.assertEqual(len(os.listdir(cache_dir)), count)
+                result = first.test_cli_runner().invoke(args=['compile-templates'])
+                self.assertIn('Compiled 0 templates (%d already up to date)' % count, result.output)
+
+            # 新的 worker 直接用缓存里的字节码, 不再编译
+            second = create_app(config)
+            def compile_again(*args, **kwargs):
+                raise AssertionError('template compiled again')
+            second.jinja_env.compile = compile_again
+            second.jinja_env.get_template('index.html')
+
     # test logout
     def test_logout(self):
         self.login()
@@ -254,6 +976,343 @@ class WatchlistTestCase(unittest.TestCase):
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    # test migrate 升级旧的数据库文件
+    def test_migrate_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            old = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmp, 'data.db')))
+            with old.app_context():
+                with db.engine.begin() as conn:
+                    MIGRATIONS[0][2](conn)
+                    conn.exec_driver_sql("INSERT INTO movie (title, year) VALUES ('Leon', '1994')")
+
+                runner = old.test_cli_runner()
+                result = runner.invoke(migrate, ['--show'])
+                self.assertIn('2 Store movie year as integer', result.output)
+                self.assertIn('[pending]', result.output)
+
+                result = runner.invoke(migrate)
+                self.assertIn('Applying 2', result.output)
+                self.assertIn('Database is up to date.', result.output)
+
+                movie = Movie.query.first()
+                self.assertEqual(movie.title, 'Leon')
+                self.assertEqual(movie.year, 1994)
+                self.assertIsNotNone(movie.created_at)
+                indexes = set(db.session.execute(db.text(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'movie'"
+                )).scalars())
+                self.assertEqual(indexes, {'ix_movie_title', 'ix_movie_year', 'ix_movie_title_lower'})
+
+                # 再执行一次什么也不做
+                result = runner.invoke(migrate)
+                self.assertNotIn('Applying', result.output)
+                db.session.remove()
+                db.engine.dispose()
+
+    # test import 批量导入
+    def test_import_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'movies.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('title,year\nLeon,1994\n,1999\nWALL-E,2008\nMahjong,19960\nMahjong,1996\n')
+            result = self.runner.invoke(import_movies, [path, '--batch-size', '2'])
+        self.assertIn('Imported 2 rows', result.output)
+        self.assertIn('Skipped line 3: invalid row.', result.output)
+        self.assertIn('Done. Imported 3 rows, skipped 2', result.output)
+        self.assertEqual(Movie.query.filter_by(title='WALL-E').first().year, 2008)
+
+        # JSON Lines 从标准输入读取
+        lines = '{"title": "Totoro", "year": 1988}\nnot json\n\n{"title": "Leon", "year": "abcd"}\n'
+        result = self.runner.invoke(args=['import', '--format', 'jsonl'], input=lines)
+        self.assertIn('Done. Imported 1 rows, skipped 2', result.output)
+        self.assertEqual(Movie.query.count(), 5)
+
+    # test export 流式导出
+    def test_export(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000 + i) for i in range(5)])
+        db.session.commit()
+        self.app.config['WATCHLIST_EXPORT_CHUNK_SIZE'] = 2
+
+        response = self.client.get('/export.csv')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,title,year')
+        self.assertEqual(lines[1], '1,Test Movie title,2023')
+        self.assertEqual(len(lines), 7)
+
+        response = self.client.get('/export.jsonl')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertIn('"title": "Movie 4", "year": 2004', lines[-1])
+
+        # 导出的文件可以再导入
+        result = self.runner.invoke(export_movies, ['--format', 'jsonl'])
+        self.assertEqual(result.output.splitlines(), lines)
+        result = self.runner.invoke(import_movies, ['--format', 'jsonl'], input=result.output)
+        self.assertIn('Imported 6 rows', result.output)
+        self.app.config['WATCHLIST_EXPORT_CHUNK_SIZE'] = 1000
+
+    # test 响应压缩
+    def test_gzip(self):
+        db.session.add_all([Movie(title='Gzip Movie %d' % i, year=2000 + i % 20) for i in range(200)])
+        db.session.commit()
+        gzip_only = {'Accept-Encoding': 'gzip'}
+
+        response = self.client.get('/?per_page=50', headers=gzip_only)
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(int(response.headers['Content-Length']), len(response.get_data()))
+        self.assertIn('Gzip Movie 48', gzip.decompress(response.get_data()).decode('utf-8'))
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('Cookie', response.headers['Vary'])
+        gzip_etag = response.headers['ETag']
+
+        response = self.client.get('/?per_page=50', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertIsNone(response.content_encoding)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        # 压缩和未压缩的响应 ETag 不同, 两种都能换来 304
+        self.assertEqual(gzip_etag, response.headers['ETag'][:-1] + '-gzip"')
+        response = self.client.get('/?per_page=50', headers=dict(gzip_only, **{'If-None-Match': gzip_etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], gzip_etag)
+
+        # 静态文件的压缩响应不能和 Range 请求的 206 共用 ETag
+        response = self.client.get('/static/style.css', headers=gzip_only)
+        self.assertEqual(response.content_encoding, 'gzip')
+        etag = response.headers['ETag']
+        response.close()
+        # 压缩版本的 ETag 也能让静态文件返回 304
+        response = self.client.get('/static/style.css', headers=dict(gzip_only, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response.close()
+        response = self.client.get('/static/style.css', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response.close()
+        response = self.client.get('/static/style.css', headers=dict(gzip_only, Range='bytes=0-9'))
+        self.assertEqual(response.status_code, 206)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response.close()
+        response = self.client.get('/static/style.css', headers=dict(gzip_only, Range='bytes=10-', **{'If-Range': etag}))
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        # 太小的响应不压缩
+        self.assertIsNone(self.client.get('/api/movies/1', headers=gzip_only).content_encoding)
+
+        # 流式响应边生成边压缩
+        self.app.config['WATCHLIST_EXPORT_CHUNK_SIZE'] = 20
+        try:
+            response = self.client.get('/export.csv', headers=gzip_only)
+            self.assertEqual(response.content_encoding, 'gzip')
+            self.assertNotIn('Content-Length', response.headers)
+            lines = gzip.decompress(response.get_data()).decode('utf-8').splitlines()
+            self.assertEqual(len(lines), 202)
+            self.assertEqual(lines[-1], '201,Gzip Movie 199,2019')
+        finally:
+            self.app.config['WATCHLIST_EXPORT_CHUNK_SIZE'] = 1000
+
+    # test SQLite 连接参数和 WAL checkpoint
+    def test_sqlite_storage_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmp, 'data.db')))
+            with other.app_context():
+                with db.engine.connect() as conn:
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA temp_store').scalar(), 2)
+
+                db.create_all()
+                db.session.add(Movie(title='WAL', year=2023))
+                db.session.commit()
+                runs = wal_checkpointer.stats()['runs']
+                result = other.test_cli_runner().invoke(checkpoint)
+                self.assertIn('Checkpointed', result.output)
+                self.assertEqual(wal_checkpointer.stats()['runs'], runs + 1)
+                self.assertEqual(wal_checkpointer.stats()['last']['mode'], 'TRUNCATE')
+                db.session.remove()
+                db.engine.dispose()
+
+        self.login()
+        data = self.client.get('/api/stats').get_json()
+        self.assertIn('hits', data['page_cache'])
+        self.assertIn('runs', data['wal_checkpoint'])
+        self.assertIn('p95_wait', data['pool']['writer'])
+        self.assertIn('p95_wait', data['pool']['reader'])
+
+    # test 连接池设置
+    def test_engine_options(self):
+        config = dict(self.app.config, SQLALCHEMY_ENGINE_OPTIONS={}, WATCHLIST_POOL_SIZE=20,
+                      SQLALCHEMY_DATABASE_URI='postgresql://watchlist@localhost/watchlist')
+        options = engine_options(config)
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertTrue(options['pool_pre_ping'])
+
+        config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/data.db'
+        self.assertNotIn('pool_pre_ping', engine_options(config))
+        config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.assertEqual(engine_options(config), {})
+
+        # 读写两个连接池分开统计, 只读请求只记在 reader 上
+        writer = pool_stats['writer'].stats()['checkouts']
+        reader = pool_stats['reader'].stats()['checkouts']
+        self.client.get('/search?q=test')
+        self.assertGreater(pool_stats['reader'].stats()['checkouts'], reader)
+        self.assertEqual(pool_stats['writer'].stats()['checkouts'], writer)
+        db.engine.dispose()
+        self.assertIs(db.engine.pool.pool_stats, pool_stats['writer'])
+        self.assertIsNone(create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'))
+                          .extensions['watchlist_pool_stats']['writer'])
+
+    # test GET 请求走只读连接
+    def test_read_routing(self):
+        reader = self.app.extensions['watchlist_reader']
+        self.assertIsNotNone(reader)
+        with reader.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('PRAGMA query_only').scalar(), 1)
+
+        executed = []
+        def record(conn, cursor, statement, *args):
+            executed.append(conn.engine)
+        event.listen(reader, 'before_cursor_execute', record)
+        try:
+            self.client.get('/api/movies')
+            self.assertIn(reader, executed)
+            self.login()
+            del executed[:]
+            self.client.post('/', data=dict(title='Routed', year='2023'))
+            self.assertNotIn(reader, executed)
+        finally:
+            event.remove(reader, 'before_cursor_execute', record)
+        self.assertEqual(self.client.get('/api/movies?per_page=5').get_json()['movies'][-1]['title'], 'Routed')
+
+        # 内存数据库没有只读连接
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'))
+        self.assertIsNone(other.extensions['watchlist_reader'])
+
+    # test ASGI 入口: 热点页面走异步驱动, 其余交给 WSGI
+    @unittest.skipIf(asgi is None, 'aiosqlite is not installed')
+    def test_asgi(self):
+        db.session.add_all([Movie(title='Async %d' % i, year=2000 + i) for i in range(3)])
+        db.session.commit()
+        application = asgi.WatchlistASGI(self.app)
+        self.assertIsNotNone(application.engine)
+        loop = asyncio.new_event_loop()
+
+        def call(method, path, query=b'', headers=(), body=b''):
+            return loop.run_until_complete(self.asgi_request(application, method, path, query, headers, body))
+
+        try:
+            status, headers, body = call('GET', '/api/movies', b'per_page=2')
+            self.assertEqual(status, 200)
+            self.assertIn(b'"Async 0"', body)
+            statements = self.capture_queries(lambda: self.assertEqual(
+                call('GET', '/api/movies/2', headers=[(b'if-none-match', headers[b'etag'])])[0], 304))
+            self.assertEqual(statements, [])
+            self.assertIn(b'Not found.', call('GET', '/api/movies/42')[2])
+            self.assertEqual(call('GET', '/api/movies', b'after=broken')[0], 400)
+
+            statements = self.capture_queries(lambda: self.assertIn(b'Async 2', call('GET', '/')[2]))
+            self.assertEqual(statements, [])
+            hits = page_cache.stats()['hits']
+            call('GET', '/')
+            self.assertEqual(page_cache.stats()['hits'], hits + 1)
+            # 测试共用一个应用上下文, 先清掉之前测试留在 g 里的登录用户
+            g.pop('_login_user', None)
+            self.assertEqual(call('GET', '/movie/edit/2')[0], 302)
+
+            # 登录和导出走 WSGI
+            status, headers, body = call('POST', '/login', headers=[
+                (b'content-type', b'application/x-www-form-urlencoded')], body=b'username=test&password=123')
+            self.assertEqual(status, 302)
+            cookie = [(b'cookie', headers[b'set-cookie'].split(b';')[0])]
+            user_cache.clear()
+            g.pop('_login_user', None)
+            status, headers, body = call('GET', '/movie/edit/2', headers=cookie)
+            self.assertEqual(status, 200)
+            self.assertIn(b'Async 0', body)
+            self.assertIn(b'Async 2', call('GET', '/export.csv', headers=cookie)[2])
+
+            # 服务器端会话的读写和模板渲染都不在事件循环的线程里做
+            threads = []
+            class RecordingInterface(ServerSessionInterface):
+                def open_session(self, app, request):
+                    threads.append(threading.get_ident())
+                    return super().open_session(app, request)
+                def save_session(self, app, session, response):
+                    threads.append(threading.get_ident())
+                    return super().save_session(app, session, response)
+            session_interface = self.app.session_interface
+            self.app.session_interface = RecordingInterface(create_session_store('memory', 3600))
+            try:
+                g.pop('_login_user', None)
+                self.assertIn(b'Async 2', call('GET', '/', b'per_page=5')[2])
+            finally:
+                self.app.session_interface = session_interface
+            self.assertEqual(len(threads), 2)
+            self.assertNotIn(threading.get_ident(), threads)
+        finally:
+            loop.run_until_complete(application.aclose())
+            loop.close()
+
+        # 内存数据库没有异步引擎, 所有请求都走 WSGI
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'))
+        self.assertIsNone(asgi.create_async_reader(other.config))
+
+    @staticmethod
+    async def asgi_request(application, method, path, query=b'', headers=(), body=b''):
+        messages = []
+        scope = dict(type='http', http_version='1.1', method=method, scheme='http', path=path,
+                     root_path='', query_string=query, headers=list(headers), server=('localhost', 80))
+
+        async def receive():
+            return dict(type='http.request', body=body, more_body=False)
+
+        async def send(message):
+            messages.append(message)
+
+        await application(scope, receive, send)
+        start = messages[0]
+        return start['status'], dict(start['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+    # test 压测脚本: 起一个本地服务器跑一小会儿
+    def test_loadtest(self):
+        report = loadtest.summarize([('GET /', 0.001 * i, 200) for i in range(1, 101)] + [('POST /', 0.5, 500)], 2.0)
+        self.assertEqual(report['routes']['GET /']['p50'], 50)
+        self.assertEqual(report['routes']['GET /']['p99'], 99)
+        self.assertEqual(report['routes']['POST /']['errors'], 1)
+        self.assertEqual(report['throughput'], 50.5)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'report.json')
+            loadtest.main(['--concurrency', '2', '--duration', '1', '--movies', '20', '--output', output,
+                           '--mix', 'anonymous=70,logged_in=20,write=10,login=10'])
+            with open(output) as f:
+                report = json.load(f)
+        self.assertGreater(report['requests'], 0)
+        self.assertEqual(report['errors'], 0)
+        self.assertGreater(report['routes']['POST /login']['requests'], 0)
+        route = report['routes']['GET /']
+        self.assertLessEqual(route['p50'], route['p95'])
+        self.assertLessEqual(route['p95'], route['p99'])
+
+    @unittest.skipUnless(TEST_DATABASE_URL, 'WATCHLIST_TEST_DATABASE_URL is not set')
+    def test_server_database(self):
+        other = create_app(dict(TESTING=True, SQLALCHEMY_DATABASE_URI=TEST_DATABASE_URL))
+        with other.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(User(name='Server', username='server'))
+            db.session.add(Movie(title='Server Movie', year=2023))
+            db.session.commit()
+            client = other.test_client()
+            self.assertIn('Server Movie', client.get('/').get_data(as_text=True))
+            self.assertEqual(client.get('/search?q=serv').status_code, 200)
+            db.session.remove()
+            db.drop_all()
+
     # test gen admin account
     def test_admin_command(self):
         db.drop_all()
@@ -275,5 +1334,4 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertTrue(User.query.first().validate_password('456'))
 
 if __name__ == '__main__':
-    with app.app_context():
-        unittest.main()
\ No newline at end of file
+    unittest.main()
\ No newline at end of file